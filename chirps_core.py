@@ -0,0 +1,406 @@
+import streamlit as st
+import rasterio
+from rasterio.windows import Window, from_bounds
+import numpy as np
+import pandas as pd
+from numba import config as numba_config, njit, prange
+from plotly.colors import sequential, hex_to_rgb
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+import itertools
+import multiprocessing
+import math
+import io
+import base64
+from pathlib import Path
+import pydeck as pdk
+import xlsxwriter
+from PIL import Image
+
+# --- Remote Read Configuration ---
+MAX_WORKERS = 16
+
+# Range reads go through GDAL's curl layer, which reuses connections per worker thread;
+# these options add keep-alive, retries on transient server errors, and timeouts so a stalled read cannot block a worker
+GDAL_HTTP_OPTIONS = dict(
+    CPL_VSIL_CURL_ALLOWED_EXTENSIONS=".tif",
+    CPL_VSIL_CURL_USE_HEAD="NO",
+    GDAL_DISABLE_READDIR_ON_OPEN="EMPTY_DIR",
+    CPL_VSIL_CURL_CHUNK_SIZE="524288",
+    GDAL_INGESTED_BYTES_AT_OPEN="32768",
+    # Keep up to 128 MB of fetched ranges in GDAL's shared region cache, so overlapping windows re-read tiles from memory
+    CPL_VSIL_CURL_CACHE_SIZE="134217728",
+    VSI_CACHE="TRUE",
+    VSI_CACHE_SIZE="16777216",
+    GDAL_HTTP_TCP_KEEPALIVE="YES",
+    GDAL_HTTP_MAX_RETRY="3",
+    GDAL_HTTP_RETRY_DELAY="0.5",
+    GDAL_HTTP_CONNECTTIMEOUT="5",
+    GDAL_HTTP_TIMEOUT="60",
+)
+
+CHIRPS_BASE_URL = "https://data.chc.ucsb.edu/products/CHIRPS/v3.0"
+
+@st.cache_resource
+def get_worker_pool():
+    """Return the worker pool shared by all sessions and reruns."""
+    # GDAL keeps its HTTP connections per thread, so long-lived workers reuse TCP/TLS sessions across requests
+    return ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="chirps")
+
+def _read_window(url, bounds):
+    """Read the window of a remote GeoTIFF covering bounds (west, south, east, north) over HTTP range requests
+    and return the raw band with its pixel-centre latitude and longitude axes."""
+    with rasterio.Env(**GDAL_HTTP_OPTIONS), rasterio.open(f"/vsicurl/{url}") as src:
+        # Read only the window covering the bounds instead of the full global grid
+        window = from_bounds(*bounds, transform=src.transform)
+        window = window.round_offsets().round_lengths().intersection(Window(0, 0, src.width, src.height))
+        band_data = src.read(1, window=window, out_dtype=np.float32)
+        height, width = band_data.shape
+
+    # CHIRPS grids are north-up, so each axis follows from the window origin and the pixel size
+    win_transform = src.window_transform(window)
+    lon_coords = (win_transform.c + (np.arange(width) + 0.5) * win_transform.a).astype(np.float32)
+    lat_coords = (win_transform.f + (np.arange(height) + 0.5) * win_transform.e).astype(np.float32)
+    return band_data, lat_coords, lon_coords
+
+def snap_to_grid(value, step=0.05):
+    """Snap a coordinate to the 0.05° CHIRPS grid so equivalent bounding boxes share one cache entry."""
+    return round(round(value / step) * step, 2)
+
+# --- Function to Read Daily Data ---
+# Keeps about a year of days for one bounding box; max_entries bounds the in-memory layer in front of the disk cache
+@st.cache_data(persist="disk", max_entries=366, show_spinner=False)
+def get_chirps_data_daily(product, date, lat_min, lat_max, lon_min, lon_max):
+    """Read the daily CHIRPS window of a product (e.g. "IMERGlate-v07" or "ERA5") and return the raw band with its pixel-centre coordinates."""
+    year = date.year
+    month = f"{date.month:02d}"
+    day = f"{date.day:02d}"
+
+    file_name = f"chirps-v3.0.{year}.{month}.{day}"
+    url = f"{CHIRPS_BASE_URL}/daily/final/{product}/{year}/{file_name}.tif"
+
+    return _read_window(url, (lon_min, lat_min, lon_max, lat_max))
+
+# --- Function to Read Monthly Data ---
+# Reads are cached per block of 5° tiles, so small changes to the bounding box are served from the cache;
+# published monthly files do not change, so blocks are kept on disk across restarts like the daily reads.
+# max_entries bounds the in-memory layer to about five years of months for one block
+TILE_SIZE = 5
+
+@st.cache_data(persist="disk", max_entries=60, show_spinner=False)
+def get_chirps_tiles(year, month, tile_lat_min, tile_lat_max, tile_lon_min, tile_lon_max):
+    """Read the window covering a block of tiles over HTTP range requests and return the raw band with its pixel-centre coordinates."""
+    lat_min, lat_max = tile_lat_min * TILE_SIZE, tile_lat_max * TILE_SIZE
+    lon_min, lon_max = tile_lon_min * TILE_SIZE, tile_lon_max * TILE_SIZE
+
+    file_name = f"chirps-v3.0.{year}.{month}"
+    url = f"{CHIRPS_BASE_URL}/monthly/global/tifs/{file_name}.tif"
+
+    return _read_window(url, (lon_min, lat_min, lon_max, lat_max))
+
+def tile_block(lat_min, lat_max, lon_min, lon_max):
+    """Return the block of 5° tiles that covers the bounding box."""
+    return (
+        math.floor(lat_min / TILE_SIZE), math.ceil(lat_max / TILE_SIZE),
+        math.floor(lon_min / TILE_SIZE), math.ceil(lon_max / TILE_SIZE),
+    )
+
+def build_monthly_dataframe(date_keys, bands, lat_coords, lon_coords, lat_min, lat_max, lon_min, lon_max):
+    """Clip every month's cached tile window to the bounding box and extract all months in one pass."""
+    # Both axes are sorted (latitude descending), so the bounding box is a row/column slice found by binary search;
+    # every month shares the same grid, so the slice is computed once
+    row_start = np.searchsorted(-lat_coords, -lat_max, side="left")
+    row_stop = np.searchsorted(-lat_coords, -lat_min, side="right")
+    col_start = np.searchsorted(lon_coords, lon_min, side="left")
+    col_stop = np.searchsorted(lon_coords, lon_max, side="right")
+
+    return build_stacked_dataframe(
+        date_keys,
+        [band[row_start:row_stop, col_start:col_stop] for band in bands],
+        lat_coords[row_start:row_stop], lon_coords[col_start:col_stop]
+    )
+
+def mean_over_months(frames):
+    """Average every pixel over the given monthly frames, giving one map point per pixel however many months are loaded."""
+    combined = pd.concat(frames, ignore_index=True)
+    return combined.groupby(["Latitude", "Longitude"], sort=False)["Value"].mean().reset_index()
+
+# --- Function to Downsample Map Points ---
+def downsample_points(df, bins):
+    """Average points onto at most a bins x bins grid so the number of map markers stays bounded."""
+    nx = min(bins, df["Longitude"].nunique())
+    ny = min(bins, df["Latitude"].nunique())
+    if nx == df["Longitude"].nunique() and ny == df["Latitude"].nunique():
+        # The grid is already small enough to plot as-is
+        return df
+
+    sums, lon_edges, lat_edges = np.histogram2d(df["Longitude"], df["Latitude"], bins=(nx, ny), weights=df["Value"])
+    counts, _, _ = np.histogram2d(df["Longitude"], df["Latitude"], bins=(lon_edges, lat_edges))
+    filled = counts > 0
+    lon_idx, lat_idx = np.nonzero(filled)
+    lon_centers = (lon_edges[:-1] + lon_edges[1:]) / 2
+    lat_centers = (lat_edges[:-1] + lat_edges[1:]) / 2
+
+    return pd.DataFrame({
+        "Latitude": lat_centers[lat_idx],
+        "Longitude": lon_centers[lon_idx],
+        "Value": sums[filled] / counts[filled]
+    })
+
+# --- Numba Kernel for Valid-Pixel Extraction ---
+# Streamlit runs scripts off the main thread; prefer the OpenMP layer, since TBB can hang on shutdown there
+numba_config.THREADING_LAYER_PRIORITY = ["omp", "tbb", "workqueue"]
+
+@njit(parallel=True, cache=True)
+def gather_valid_pixels(stack, lat_coords, lon_coords, nodata):
+    """Gather the day index, coordinates and value of every valid pixel in two parallel passes."""
+    n_days, height, width = stack.shape
+    n_rows = n_days * height
+
+    # A pixel is valid unless it is NoData or NaN
+    # Pass 1: count valid pixels per (day, row) to find where each row starts in the output
+    row_counts = np.zeros(n_rows + 1, dtype=np.int64)
+    for r in prange(n_rows):
+        day, i = r // height, r % height
+        n_valid = 0
+        for j in range(width):
+            value = stack[day, i, j]
+            if value != nodata and not np.isnan(value):
+                n_valid += 1
+        row_counts[r + 1] = n_valid
+    offsets = np.cumsum(row_counts)
+
+    n_total = offsets[-1]
+    out_day = np.empty(n_total, dtype=np.int32)
+    out_lat = np.empty(n_total, dtype=lat_coords.dtype)
+    out_lon = np.empty(n_total, dtype=lon_coords.dtype)
+    out_val = np.empty(n_total, dtype=stack.dtype)
+
+    # Pass 2: every row fills its own slice, so no atomic counter is needed
+    for r in prange(n_rows):
+        day, i = r // height, r % height
+        k = offsets[r]
+        for j in range(width):
+            value = stack[day, i, j]
+            if value != nodata and not np.isnan(value):
+                out_day[k] = day
+                out_lat[k] = lat_coords[i]
+                out_lon[k] = lon_coords[j]
+                out_val[k] = value
+                k += 1
+
+    return out_day, out_lat, out_lon, out_val
+
+# --- Function to Combine Same-Window Bands ---
+def build_stacked_dataframe(date_keys, bands, lat_coords, lon_coords):
+    """Stack windows that share one grid (one per date) and extract every valid pixel of every date in one vectorised pass."""
+    stack = np.stack(bands, axis=0)
+    day_idx, lats, lons, values = gather_valid_pixels(stack, lat_coords, lon_coords, -9999.0)
+
+    # The kernel outputs are fresh arrays, so pandas can adopt them without copying; Date_Range is stored as category codes
+    return pd.DataFrame({
+        "Latitude": lats,
+        "Longitude": lons,
+        "Value": values,
+        "Date_Range": pd.Categorical.from_codes(day_idx, categories=date_keys)
+    }, copy=False)
+
+# --- Functions to Process a Date Range ---
+def is_valid_bbox(lat_min, lat_max, lon_min, lon_max):
+    """Return whether the bounding box has a window to read."""
+    # An empty or inverted box is rejected once instead of failing on every date
+    return lat_min < lat_max and lon_min < lon_max
+
+def clear_processed_data():
+    """Delete the session's processed files and reset the state that refers to them."""
+    for old_path in st.session_state.chirps_data.values():
+        Path(old_path).unlink(missing_ok=True)
+    st.session_state.chirps_data = {}
+    # The monthly page's cached mean is built from chirps_data, so it goes whenever any page replaces the data
+    if st.session_state.get("monthly_mean") is not None:
+        Path(st.session_state.monthly_mean).unlink(missing_ok=True)
+    st.session_state.monthly_mean = None
+    st.session_state.data_processed = False
+    st.session_state.show_map = False
+    st.session_state.processed_plan = None
+
+def process_date_range(tasks, plan, error_message, clip_to=None):
+    """Run the reads in tasks ({date key: (read function, *args)}) on the worker pool and store each date as a Parquet file.
+
+    Every read must return a window on the same grid. With clip_to (lat_min, lat_max, lon_min, lon_max), the shared
+    window is clipped to that bounding box before extraction.
+    """
+    clear_processed_data()
+    results = {}
+
+    progress_bar = st.progress(0)
+    # Reads are I/O-bound, so run them concurrently. The pool is shared by all sessions, so a run keeps at most
+    # MAX_WORKERS reads in flight and cancels the ones still queued if it stops early (e.g. a rerun or closed tab)
+    executor = get_worker_pool()
+    pending = iter(tasks.items())
+    futures = {executor.submit(*task): date_key for date_key, task in itertools.islice(pending, MAX_WORKERS)}
+    n_done = 0
+    try:
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                date_key = futures.pop(future)
+                try:
+                    results[date_key] = future.result()
+                except Exception as e:
+                    st.error(error_message.format(date_key=date_key, error=e))
+                n_done += 1
+                progress_bar.progress(n_done / len(tasks))
+                for next_key, next_task in itertools.islice(pending, 1):
+                    futures[executor.submit(*next_task)] = next_key
+    finally:
+        for future in futures:
+            future.cancel()
+
+    if results:
+        # Every date shares the same window, so the dates are stacked and extracted together
+        date_keys = sorted(results)
+        _, lat_coords, lon_coords = results[date_keys[0]]
+        bands = [results[key][0] for key in date_keys]
+        if clip_to is None:
+            df_all = build_stacked_dataframe(date_keys, bands, lat_coords, lon_coords)
+        else:
+            df_all = build_monthly_dataframe(date_keys, bands, lat_coords, lon_coords, *clip_to)
+        for date_key, df_date in df_all.groupby("Date_Range", observed=True, sort=False):
+            parquet_path = Path(st.session_state.tmpdir.name) / f"{date_key}.parquet"
+            df_date.to_parquet(parquet_path, compression='zstd', index=False)
+            st.session_state.chirps_data[date_key] = str(parquet_path)
+
+    # Only a run without failures that produced data is reused, so clicking again retries dates that failed
+    # and keeps showing the no-data warning for an area without valid pixels
+    if len(results) == len(tasks) and st.session_state.chirps_data:
+        st.session_state.processed_plan = plan
+
+# --- Function to Write Excel Files ---
+# An Excel sheet holds 1,048,576 rows including the header; larger frames are only offered as Parquet
+EXCEL_MAX_ROWS = 1048575
+# constant_memory keeps one temp file open per sheet until the workbook closes, so sheets per workbook are capped
+# well below the usual 1024 open-file limit; longer daily ranges are split into several workbooks
+EXCEL_MAX_SHEETS = 366
+
+def write_excel_sheets(buffer, sheets):
+    """Write (sheet name, DataFrame) pairs row by row using xlsxwriter's constant_memory mode."""
+    # pandas' to_excel writes column by column, but constant_memory only accepts rows in order
+    with xlsxwriter.Workbook(buffer, {"constant_memory": True}) as workbook:
+        coord_format = workbook.add_format({"num_format": "0.000"})
+        for sheet_name, df in sheets:
+            worksheet = workbook.add_worksheet(sheet_name[:31])
+            # Show float32 coordinates with 3 decimals to match the 0.05° grid
+            for col_idx, column in enumerate(df.columns):
+                if column in ("Latitude", "Longitude"):
+                    worksheet.set_column(col_idx, col_idx, None, coord_format)
+            worksheet.write_row(0, 0, df.columns)
+            for row_idx, row in enumerate(df.itertuples(index=False, name=None), start=1):
+                worksheet.write_row(row_idx, 0, row)
+
+# Each worker process re-imports this module (Streamlit, Numba, rasterio), so only a few are started per export
+EXCEL_MAX_PROCESSES = 4
+
+def excel_process_pool(n_files):
+    """Return a process pool for writing n_files workbooks; use it in a with block so the workers exit with the export."""
+    # xlsxwriter is pure Python and holds the GIL; "spawn" avoids forking a process that already runs OpenMP threads
+    return ProcessPoolExecutor(max_workers=max(1, min(EXCEL_MAX_PROCESSES, n_files)), mp_context=multiprocessing.get_context("spawn"))
+
+def write_excel_file(sheet_name, parquet_path, excel_path):
+    """Write the Parquet file to excel_path as a single-sheet workbook; defined at module level so worker processes can run it."""
+    # Workers read and write the files themselves, so only paths cross the process boundary
+    write_excel_sheets(excel_path, [(sheet_name, pd.read_parquet(parquet_path))])
+
+def write_excel_files(jobs):
+    """Write each (sheet name, Parquet path, Excel path) job and yield (job, error) in job order; error is None on success."""
+    # Starting the workers costs more than writing a few workbooks, so short exports are written in this process
+    if len(jobs) < 2 * EXCEL_MAX_PROCESSES:
+        for job in jobs:
+            try:
+                write_excel_file(*job)
+                error = None
+            except Exception as e:
+                error = e
+            yield job, error
+        return
+
+    with excel_process_pool(len(jobs)) as process_pool:
+        futures = [process_pool.submit(write_excel_file, *job) for job in jobs]
+        for job, future in zip(jobs, futures):
+            yield job, future.exception()
+
+# --- Map Color Scale ---
+VIRIDIS_RGB = np.array([hex_to_rgb(color) for color in sequential.Viridis], dtype=float)
+
+# --- Function to Prepare Map Data ---
+@st.cache_data(max_entries=32, show_spinner=False)
+def prepare_map_data(df, detail):
+    """Downsample and colour the points once per day and detail level; point-size changes reuse the result."""
+    df = downsample_points(df[["Latitude", "Longitude", "Value"]], detail)
+
+    # Viridis colours are computed once on the server; WebGL then draws every point in a single pass in the browser
+    min_v, max_v = df["Value"].min(), df["Value"].max()
+    scaled = (df["Value"] - min_v) / (max_v - min_v) if max_v > min_v else np.zeros(len(df))
+    stops = np.linspace(0, 1, len(VIRIDIS_RGB))
+    df = df.round({"Latitude": 3, "Longitude": 3, "Value": 2}).assign(
+        r=np.interp(scaled, stops, VIRIDIS_RGB[:, 0]).astype(np.uint8),
+        g=np.interp(scaled, stops, VIRIDIS_RGB[:, 1]).astype(np.uint8),
+        b=np.interp(scaled, stops, VIRIDIS_RGB[:, 2]).astype(np.uint8),
+    )
+    return df, min_v, max_v
+
+# --- Function to Rasterize Map Points ---
+@st.cache_data(max_entries=32, show_spinner=False)
+def rasterize_points(df, width=1200, height=800):
+    """Average points onto at most a width x height grid and return it as a Viridis PNG data URI with its bounds and value range."""
+    # Pad by half a 0.05° cell so the image edges line up with the outer pixel edges, not their centres
+    lon_range = (df["Longitude"].min() - 0.025, df["Longitude"].max() + 0.025)
+    lat_range = (df["Latitude"].min() - 0.025, df["Latitude"].max() + 0.025)
+    # Size the image from the extent, not the distinct coordinates, so columns or rows of NoData keep one cell per pixel
+    nx = min(width, round((lon_range[1] - lon_range[0]) / 0.05))
+    ny = min(height, round((lat_range[1] - lat_range[0]) / 0.05))
+    sums, lon_edges, lat_edges = np.histogram2d(df["Longitude"], df["Latitude"], bins=(nx, ny), range=(lon_range, lat_range), weights=df["Value"])
+    counts, _, _ = np.histogram2d(df["Longitude"], df["Latitude"], bins=(lon_edges, lat_edges))
+    filled = counts > 0
+    means = np.divide(sums, counts, out=np.zeros_like(sums), where=filled)
+
+    min_v, max_v = means[filled].min(), means[filled].max()
+    scaled = (means - min_v) / (max_v - min_v) if max_v > min_v else np.zeros_like(means)
+    stops = np.linspace(0, 1, len(VIRIDIS_RGB))
+    rgba = np.zeros(means.shape + (4,), dtype=np.uint8)
+    for channel in range(3):
+        rgba[..., channel] = np.interp(scaled, stops, VIRIDIS_RGB[:, channel])
+    rgba[..., 3] = np.where(filled, 255, 0)
+
+    # histogram2d indexes cells as [lon, lat]; image rows run from the northern edge downwards
+    buffer = io.BytesIO()
+    Image.fromarray(np.ascontiguousarray(rgba.transpose(1, 0, 2)[::-1])).save(buffer, format="PNG")
+    data_uri = "data:image/png;base64," + base64.b64encode(buffer.getvalue()).decode()
+    return data_uri, (float(lon_edges[0]), float(lon_edges[-1]), float(lat_edges[0]), float(lat_edges[-1])), min_v, max_v
+
+# --- Function to Show a Daily Map ---
+def show_daily_map(df, date_str, point_size, detail, text):
+    """Draw the day's points with pydeck; text holds the page's info, title, value_label and caption strings."""
+    st.info(text["info"])
+
+    df, min_v, max_v = prepare_map_data(df, detail)
+
+    layer = pdk.Layer(
+        "ScatterplotLayer",
+        data=df,
+        get_position=["Longitude", "Latitude"],
+        get_fill_color="[r, g, b]",
+        get_radius=point_size / 2,
+        radius_units="pixels",
+        pickable=True,
+    )
+    view_state = pdk.ViewState(latitude=df["Latitude"].mean(), longitude=df["Longitude"].mean(), zoom=5)
+    deck = pdk.Deck(
+        layers=[layer],
+        initial_view_state=view_state,
+        map_style=pdk.map_styles.ROAD,
+        tooltip={"text": f"Latitude: {{Latitude}}\nLongitude: {{Longitude}}\n{text['value_label']}: {{Value}}"},
+    )
+
+    st.markdown(f"**{text['title']} - {date_str}**")
+    st.pydeck_chart(deck, use_container_width=True)
+    st.caption(text["caption"].format(min_v=min_v, max_v=max_v))
@@ -1,12 +1,10 @@
 import streamlit as st
-import requests
-import rasterio
-import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
-import plotly.express as px
 import os
 import io
+import tempfile
+from chirps_core import snap_to_grid, get_chirps_data_daily, is_valid_bbox, process_date_range, EXCEL_MAX_ROWS, write_excel_sheets, show_daily_map
 
 # --- Konfigurasi Aplikasi Streamlit ---
 st.set_page_config(
@@ -16,12 +14,18 @@ st.set_page_config(
 )
 
 # --- Inisialisasi Session State ---
+# Data harian disimpan sebagai file Parquet di folder sementara per sesi; session state hanya menyimpan path-nya.
+# Folder dihapus saat state sesi dilepas atau server berhenti
 if 'chirps_data' not in st.session_state:
     st.session_state.chirps_data = {}
+if 'tmpdir' not in st.session_state:
+    st.session_state.tmpdir = tempfile.TemporaryDirectory(prefix="chirps_")
+if 'processed_plan' not in st.session_state:
+    st.session_state.processed_plan = None
 
 # --- Judul Aplikasi ---
 st.title("🌧️ CHIRPS ERA5 Daily Data")
-st.markdown("Aplikasi ini memungkinkan Anda mengunduh, memproses, dan memvisualisasikan data curah hujan harian CHIRPS v3.0 (ERA5). Hasil diunduh dalam format Excel agar mudah diolah.")
+st.markdown("Aplikasi ini memungkinkan Anda mengunduh, memproses, dan memvisualisasikan data curah hujan harian CHIRPS v3.0 (ERA5). Hasil diunduh dalam format Parquet atau Excel agar mudah diolah.")
 st.markdown("Dibuat Tsaqib")
 
 # --- Input Pengguna di Sidebar ---
@@ -34,6 +38,7 @@ with col_end:
     end_date = st.date_input("Tanggal Akhir:", value=datetime(2000, 1, 1), key='end_date')
 
 point_size = st.sidebar.slider("Atur Ukuran Titik:", min_value=1, max_value=20, value=8, step=1)
+map_detail = st.sidebar.slider("Atur Detail Peta (sel per sumbu):", min_value=50, max_value=500, value=200, step=50)
 
 st.sidebar.markdown("---")
 st.sidebar.header("Atur Batas Geografis")
@@ -46,97 +51,45 @@ with col2:
     lon_min = st.number_input("Min Longitude:", value=0, step=0.1, format="%.1f")
     lon_max = st.number_input("Max Longitude:", value=0, step=0.1, format="%.1f")
 
-# --- Fungsi untuk Mengunduh dan Memproses Data ---
-@st.cache_data(ttl=3600)
-def get_chirps_data_daily(date, lat_min, lat_max, lon_min, lon_max):
-    """Mengunduh data CHIRPS harian (ERA5), memprosesnya, dan mengembalikan DataFrame."""
-    year = date.year
-    month = f"{date.month:02d}"
-    day = f"{date.day:02d}"
-    
-    file_name = f"chirps-v3.0.{year}.{month}.{day}"
-    # Perubahan URL untuk mengambil dari direktori ERA5
-    url = f"https://data.chc.ucsb.edu/products/CHIRPS/v3.0/daily/final/ERA5/{year}/{file_name}.tif"
-
-    try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-
-        tif_in_memory = io.BytesIO()
-        for chunk in response.iter_content(chunk_size=8192):
-            tif_in_memory.write(chunk)
-        tif_in_memory.seek(0)
-
-        with rasterio.open(tif_in_memory) as src:
-            band_data = src.read(1)
-            band_data = np.where(band_data == -9999.0, np.nan, band_data)
-            height, width = band_data.shape
-
-            lon_coords = np.linspace(src.bounds.left, src.bounds.right, width)
-            lat_coords = np.linspace(src.bounds.top, src.bounds.bottom, height)
-            lon, lat = np.meshgrid(lon_coords, lat_coords)
-
-            df = pd.DataFrame({
-                "Latitude": lat.flatten(),
-                "Longitude": lon.flatten(),
-                "Value": band_data.flatten()
-            })
-
-            df.dropna(inplace=True)
-            df_filtered = df[
-                (df["Latitude"] >= lat_min) & (df["Latitude"] <= lat_max) &
-                (df["Longitude"] >= lon_min) & (df["Longitude"] <= lon_max)
-            ].copy()
-
-            df_filtered['Date_Range'] = date.strftime('%Y-%m-%d')
-            
-            return df_filtered
-
-    except Exception as e:
-        st.error(f"❌ Gagal memproses data {date.strftime('%Y-%m-%d')}: {e}")
-        return pd.DataFrame()
-
-# --- Fungsi untuk Membuat Peta ---
-def create_map(df, date_str, point_size):
-    st.info("Peta ini menampilkan ukuran titik yang konsisten. Anda dapat mengatur ukurannya menggunakan slider di sidebar.")
-
-    fig = px.scatter_mapbox(df,
-                            lat="Latitude",
-                            lon="Longitude",
-                            color="Value",
-                            color_continuous_scale=px.colors.sequential.Viridis,
-                            zoom=5,
-                            mapbox_style="open-street-map",
-                            title=f"Curah Hujan (mm/hari) - {date_str}",
-                            hover_data={"Latitude": ':.2f', "Longitude": ':.2f', "Value": ':.2f'})
-    
-    fig.update_layout(
-        margin={"r":0,"t":40,"l":0,"b":0},
-        coloraxis_colorbar=dict(title="Curah Hujan (mm)"),
-    )
-
-    fig.update_traces(marker=dict(size=point_size))
+st.sidebar.markdown("---")
+st.sidebar.header("Opsi Unduhan")
+bulk_format = st.sidebar.radio("Format Unduhan:", ["Parquet", "Excel"], help="Parquet jauh lebih cepat dibuat dan lebih kecil untuk diunduh. Excel lebih lambat untuk rentang tanggal yang panjang.")
 
-    st.plotly_chart(fig, use_container_width=True)
+# Hasil baca yang di-cache juga disimpan di disk dan tidak kedaluwarsa, jadi dapat dihapus di sini
+st.sidebar.markdown("---")
+if st.sidebar.button("Hapus Cache 🗑️"):
+    get_chirps_data_daily.clear()
+    st.sidebar.success("Cache data harian berhasil dihapus.")
+
+# --- Teks Peta ---
+MAP_TEXT = {
+    "info": "Peta ini menampilkan ukuran titik yang konsisten. Anda dapat mengatur ukurannya menggunakan slider di sidebar. Wilayah yang luas dirata-ratakan ke grid yang lebih kasar; naikkan Detail Peta untuk menampilkan lebih banyak titik.",
+    "title": "Curah Hujan (mm/hari)",
+    "value_label": "Curah Hujan (mm)",
+    "caption": "Skala warna (Viridis): {min_v:.2f} mm (ungu tua) hingga {max_v:.2f} mm (kuning)",
+}
 
 # --- Tombol Aksi ---
 st.markdown("---")
 col_buttons = st.columns(2)
 
 if col_buttons[0].button('Proses Data & Tampilkan Peta 🗺️'):
+    bbox = [snap_to_grid(value) for value in (lat_min, lat_max, lon_min, lon_max)]
+    # Input yang menentukan data; klik ulang dengan input yang sama memakai data yang sudah diproses
+    plan = (start_date, end_date, *bbox)
+
     if start_date > end_date:
         st.error("Tanggal awal tidak boleh lebih besar dari tanggal akhir.")
+    elif not is_valid_bbox(*bbox):
+        st.error("Latitude dan longitude minimum harus lebih kecil dari nilai maksimumnya.")
+    elif plan == st.session_state.processed_plan:
+        st.info("Rentang tanggal dan wilayah ini sudah diproses.")
     else:
-        st.session_state.chirps_data = {}  # Reset data
-        current_date = start_date
-        
+        dates = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+        tasks = {date.strftime('%Y-%m-%d'): (get_chirps_data_daily, "ERA5", date, *bbox) for date in dates}
+
         with st.spinner(f'Mengunduh dan memproses data dari {start_date} s.d. {end_date}...'):
-            while current_date <= end_date:
-                df_chirps = get_chirps_data_daily(current_date, lat_min, lat_max, lon_min, lon_max)
-                if not df_chirps.empty:
-                    st.session_state.chirps_data[current_date.strftime('%Y-%m-%d')] = df_chirps
-                
-                current_date += timedelta(days=1)
+            process_date_range(tasks, plan, "❌ Gagal memproses data {date_key}: {error}")
 
         if st.session_state.chirps_data:
             st.success("✅ Semua data berhasil diproses!")
@@ -149,29 +102,44 @@ if st.session_state.chirps_data:
     selected_date_index = st.slider("Pilih Tanggal untuk Peta:", 0, len(dates) - 1, 0, format=dates[0])
     selected_date = dates[selected_date_index]
     
-    df_to_display = st.session_state.chirps_data[selected_date]
-    create_map(df_to_display, selected_date, point_size)
+    df_to_display = pd.read_parquet(st.session_state.chirps_data[selected_date])
+    show_daily_map(df_to_display, selected_date, point_size, map_detail, MAP_TEXT)
 
-if col_buttons[1].button('Download Semua Data Excel ⬇️'):
+if col_buttons[1].button('Download Semua Data ⬇️'):
     if not st.session_state.chirps_data:
         st.error("Harap proses data terlebih dahulu sebelum mengunduh.")
     else:
         with st.spinner('Menggabungkan dan memproses data untuk diunduh...'):
-            combined_df = pd.concat(list(st.session_state.chirps_data.values()), ignore_index=True)
-            excel_buffer = io.BytesIO()
-            combined_df.to_excel(excel_buffer, index=False, engine='xlsxwriter')
-            excel_buffer.seek(0)
-            
+            combined_df = pd.concat([pd.read_parquet(path) for path in st.session_state.chirps_data.values()], ignore_index=True)
             start_date_str = sorted(st.session_state.chirps_data.keys())[0]
             end_date_str = sorted(st.session_state.chirps_data.keys())[-1]
 
-            st.download_button(
-                label="Klik untuk Mengunduh File Excel",
-                data=excel_buffer,
-                file_name=f"CHIRPS_Daily_ERA5_Data_{start_date_str}_to_{end_date_str}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-            )
-            st.success("✅ File Excel siap diunduh!")
+            if bulk_format == "Excel" and len(combined_df) > EXCEL_MAX_ROWS:
+                st.error(f"Data berisi {len(combined_df):,} baris, melebihi batas {EXCEL_MAX_ROWS:,} baris per sheet Excel. Pilih format Parquet atau perkecil rentang tanggal/wilayah.")
+            elif bulk_format == "Parquet":
+                parquet_buffer = io.BytesIO()
+                combined_df.to_parquet(parquet_buffer, engine='pyarrow', compression='zstd', index=False)
+                parquet_buffer.seek(0)
+
+                st.download_button(
+                    label="Klik untuk Mengunduh File Parquet",
+                    data=parquet_buffer,
+                    file_name=f"CHIRPS_Daily_ERA5_Data_{start_date_str}_to_{end_date_str}.parquet",
+                    mime="application/vnd.apache.parquet"
+                )
+                st.success("✅ File Parquet siap diunduh!")
+            else:
+                excel_buffer = io.BytesIO()
+                write_excel_sheets(excel_buffer, [("Sheet1", combined_df)])
+                excel_buffer.seek(0)
+
+                st.download_button(
+                    label="Klik untuk Mengunduh File Excel",
+                    data=excel_buffer,
+                    file_name=f"CHIRPS_Daily_ERA5_Data_{start_date_str}_to_{end_date_str}.xlsx",
+                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                )
+                st.success("✅ File Excel siap diunduh!")
 
 st.markdown("---")
 st.info("Catatan: Data CHIRPS diunduh dari [CHG UCSB](https://data.chc.ucsb.edu/products/CHIRPS/).")
\ No newline at end of file
@@ -1,13 +1,16 @@
 import streamlit as st
-import requests
-import rasterio
-import numpy as np
 import pandas as pd
 from datetime import datetime
+import calendar
 import plotly.express as px
+import plotly.graph_objects as go
 import os
 import io
 import zipfile
+import tempfile
+from pathlib import Path
+import pyarrow.parquet as pq
+from chirps_core import get_chirps_tiles, tile_block, is_valid_bbox, process_date_range, mean_over_months, rasterize_points, EXCEL_MAX_ROWS, write_excel_files
 
 # --- Streamlit Application Configuration ---
 st.set_page_config(
@@ -17,16 +20,24 @@ st.set_page_config(
 )
 
 # --- Initialize Session State ---
+# Processed months are stored as Parquet files in a per-session temp directory; session state only keeps their paths.
+# The directory is deleted when the session's state is released or the server stops
 if 'chirps_data' not in st.session_state:
     st.session_state.chirps_data = {}
+if 'tmpdir' not in st.session_state:
+    st.session_state.tmpdir = tempfile.TemporaryDirectory(prefix="chirps_")
 if 'data_processed' not in st.session_state:
     st.session_state.data_processed = False
 if 'show_map' not in st.session_state:
     st.session_state.show_map = False
+if 'monthly_mean' not in st.session_state:
+    st.session_state.monthly_mean = None
+if 'processed_plan' not in st.session_state:
+    st.session_state.processed_plan = None
 
 # --- Application Title ---
 st.title("🌧️ CHIRPS Monthly Data")
-st.markdown("This application allows you to download, process, and visualize CHIRPS v3.0 monthly rainfall data at a resolution of 0.05 degrees. The data is downloaded in Excel format for easy processing.")
+st.markdown("This application allows you to download, process, and visualize CHIRPS v3.0 monthly rainfall data at a resolution of 0.05 degrees. The data is downloaded in Parquet or Excel format for easy processing.")
 
 st.markdown("""
 This page is designed for downloading monthly rainfall data. Follow these steps:
@@ -35,13 +46,13 @@ This page is designed for downloading monthly rainfall data. Follow these steps:
 3.  **Adjust Point Size**: Use the slider to control the size of the data points on the map visualization.
 4.  **Process Data**: Click the **'Process Data'** button. The application will begin downloading and processing data for each month within your specified range. Please wait until the process is complete.
 5.  **Display & Download**:
-    * Once the data is processed, click the **'Show Map'** button to view an interactive map. If you've selected more than one month, a slider will appear, allowing you to switch between the maps for each month.
-    * Click the **'Download All Data (ZIP)'** button to download all the processed data in a single ZIP file, containing a separate Excel file (.xlsx) for each month.
+    * Once the data is processed, click the **'Show Map'** button to view an interactive map. If you've selected more than one month, a slider will appear, allowing you to switch between the maps for each month, along with an option to map the mean of all months.
+    * Click the **'Download All Data'** button to download all the processed data. **Parquet** (default) gives a single file with a `Date_Range` column; **Excel** gives a ZIP file containing a separate Excel file (.xlsx) for each month.
 """)
 # --- Year & Month Range Setup ---
 START_YEAR = 1981
 END_YEAR = datetime.now().year
-MONTH_OPTIONS = [{'label': datetime(2000, m, 1).strftime('%B'), 'value': f"{m:02d}"} for m in range(1, 13)]
+MONTH_LABELS = [calendar.month_name[m] for m in range(1, 13)]
 
 # --- User Input in Sidebar ---
 st.sidebar.header("Select Date Range")
@@ -49,11 +60,11 @@ col_start, col_end = st.sidebar.columns(2)
 
 with col_start:
     start_year = st.selectbox("Start Year:", options=list(range(START_YEAR, END_YEAR + 1)), index=len(range(START_YEAR, END_YEAR + 1)) - 1, key='start_year')
-    start_month = st.selectbox("Start Month:", options=MONTH_OPTIONS, format_func=lambda x: x['label'], key='start_month')['value']
+    start_month = st.selectbox("Start Month:", options=range(1, 13), format_func=lambda m: MONTH_LABELS[m - 1], key='start_month')
 
 with col_end:
     end_year = st.selectbox("End Year:", options=list(range(START_YEAR, END_YEAR + 1)), index=len(range(START_YEAR, END_YEAR + 1)) - 1, key='end_year')
-    end_month = st.selectbox("End Month:", options=MONTH_OPTIONS, format_func=lambda x: x['label'], key='end_month')['value']
+    end_month = st.selectbox("End Month:", options=range(1, 13), format_func=lambda m: MONTH_LABELS[m - 1], key='end_month')
 
 point_size = st.sidebar.slider("Set Point Size:", min_value=1, max_value=20, value=8, step=1)
 
@@ -68,101 +79,89 @@ with col2:
     lon_min = st.number_input("Longitude (Min):", value=104.0, step=0.1, format="%.1f")
     lon_max = st.number_input("Longitude (Max):", value=115.0, step=0.1, format="%.1f")
 
-# --- Function to Download and Process Data ---
-@st.cache_data(ttl=3600)
-def get_chirps_data(year, month, lat_min, lat_max, lon_min, lon_max):
-    """Download, process, and return CHIRPS data as a DataFrame."""
-    file_name = f"chirps-v3.0.{year}.{month}"
-    url = f"https://data.chc.ucsb.edu/products/CHIRPS/v3.0/monthly/global/tifs/{file_name}.tif"
-
-    try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-
-        tif_in_memory = io.BytesIO()
-        for chunk in response.iter_content(chunk_size=8192):
-            tif_in_memory.write(chunk)
-        tif_in_memory.seek(0)
-
-        with rasterio.open(tif_in_memory) as src:
-            band_data = src.read(1)
-            band_data = np.where(band_data == -9999.0, np.nan, band_data)
-            height, width = band_data.shape
-
-            lon_coords = np.linspace(src.bounds.left, src.bounds.right, width)
-            lat_coords = np.linspace(src.bounds.top, src.bounds.bottom, height)
-            lon, lat = np.meshgrid(lon_coords, lat_coords)
-
-            df = pd.DataFrame({
-                "Latitude": lat.flatten(),
-                "Longitude": lon.flatten(),
-                "Value": band_data.flatten()
-            })
-
-            df.dropna(inplace=True)
-            df_filtered = df[
-                (df["Latitude"] >= lat_min) & (df["Latitude"] <= lat_max) &
-                (df["Longitude"] >= lon_min) & (df["Longitude"] <= lon_max)
-            ].copy()
-
-            df_filtered['Date_Range'] = f"{year}-{month}"
-            
-            return df_filtered
-
-    except Exception as e:
-        st.error(f"❌ Failed to process data for {month}/{year}: {e}")
-        return pd.DataFrame()
+st.sidebar.markdown("---")
+st.sidebar.header("Download Options")
+bulk_format = st.sidebar.radio("Bulk Download Format:", ["Parquet", "Excel"], help="Parquet is much faster to create and smaller to download. Excel is slower for long date ranges.")
+
+# Cached reads are also kept on disk and never expire, so they can be removed here
+st.sidebar.markdown("---")
+if st.sidebar.button("Clear Cache 🗑️"):
+    get_chirps_tiles.clear()
+    st.sidebar.success("Cached monthly reads removed.")
 
 # --- Function to Create Map ---
+# Above this many points, individual markers make the browser sluggish, so the grid is rendered on the server
+# and sent as a single image; grids up to 1200 x 800 cells are drawn at full resolution
+RASTER_MAP_THRESHOLD = 20000
+
 def create_map(df, date_str, point_size):
-    st.info("This map shows consistent point size. You can adjust the size using the slider in the sidebar.")
-
-    fig = px.scatter_mapbox(df,
-                            lat="Latitude",
-                            lon="Longitude",
-                            color="Value",
-                            color_continuous_scale=px.colors.sequential.Viridis,
-                            zoom=5,
-                            mapbox_style="open-street-map",
-                            title=f"Rainfall (mm/month) - {date_str}",
-                            hover_data={"Latitude": ':.2f', "Longitude": ':.2f', "Value": ':.2f'})
+    if len(df) > RASTER_MAP_THRESHOLD:
+        st.info(f"This area has {len(df):,} points, so it is drawn as an image of the grid. Very large areas are averaged onto a coarser grid. Hover values are not available in this view.")
+
+        data_uri, (west, east, south, north), min_v, max_v = rasterize_points(df)
+        center_lat, center_lon = (south + north) / 2, (west + east) / 2
+        # An invisible two-point trace carries the colour bar for the image layer
+        fig = go.Figure(go.Scattermapbox(
+            lat=[center_lat, center_lat],
+            lon=[center_lon, center_lon],
+            mode="markers",
+            marker=dict(size=0, color=[min_v, max_v], coloraxis="coloraxis"),
+            hoverinfo="skip",
+        ))
+        fig.update_layout(
+            title=f"Rainfall (mm/month) - {date_str}",
+            coloraxis=dict(colorscale=px.colors.sequential.Viridis, cmin=min_v, cmax=max_v),
+            mapbox=dict(
+                style="open-street-map",
+                zoom=5,
+                center=dict(lat=center_lat, lon=center_lon),
+                layers=[dict(sourcetype="image", source=data_uri, coordinates=[[west, north], [east, north], [east, south], [west, south]])],
+            ),
+        )
+    else:
+        st.info("This map shows consistent point size. You can adjust the size using the slider in the sidebar.")
+
+        fig = px.scatter_mapbox(df,
+                                lat="Latitude",
+                                lon="Longitude",
+                                color="Value",
+                                color_continuous_scale=px.colors.sequential.Viridis,
+                                zoom=5,
+                                mapbox_style="open-street-map",
+                                title=f"Rainfall (mm/month) - {date_str}",
+                                hover_data={"Latitude": ':.2f', "Longitude": ':.2f', "Value": ':.2f'})
+        fig.update_traces(marker=dict(size=point_size))
     
     fig.update_layout(
         margin={"r":0,"t":40,"l":0,"b":0},
         coloraxis_colorbar=dict(title="Rainfall (mm)"),
     )
 
-    fig.update_traces(marker=dict(size=point_size))
-
     st.plotly_chart(fig, use_container_width=True)
 
 # --- Action Buttons ---
 st.markdown("---")
 if st.button('Process Data'):
-    start_date_obj = datetime(start_year, int(start_month), 1)
-    end_date_obj = datetime(end_year, int(end_month), 1)
+    start_date_obj = datetime(start_year, start_month, 1)
+    end_date_obj = datetime(end_year, end_month, 1)
+    # The inputs that determine the data; clicking again with the same inputs keeps the processed months
+    plan = (start_year, start_month, end_year, end_month, lat_min, lat_max, lon_min, lon_max)
 
     if start_date_obj > end_date_obj:
         st.error("The start date cannot be later than the end date.")
+    elif not is_valid_bbox(lat_min, lat_max, lon_min, lon_max):
+        st.error("The minimum latitude and longitude must be smaller than the maximum values.")
+    elif plan == st.session_state.processed_plan:
+        st.info("This date range and area are already processed.")
     else:
-        st.session_state.chirps_data = {}
-        st.session_state.data_processed = False
-        st.session_state.show_map = False # Reset map status
-        current_date = start_date_obj
-        
+        month_starts = pd.date_range(start_date_obj, end_date_obj, freq='MS')
+        # Workers only fetch the tile windows; cached months return straight from memory
+        tiles = tile_block(lat_min, lat_max, lon_min, lon_max)
+        tasks = {f"{year}-{month:02d}": (get_chirps_tiles, year, f"{month:02d}", *tiles) for year, month in zip(month_starts.year, month_starts.month)}
+
         with st.spinner(f'Downloading and processing data from {start_date_obj.strftime("%Y-%m")} to {end_date_obj.strftime("%Y-%m")}...'):
-            while current_date <= end_date_obj:
-                year = current_date.year
-                month = f"{current_date.month:02d}"
-                
-                df_chirps = get_chirps_data(year, month, lat_min, lat_max, lon_min, lon_max)
-                if not df_chirps.empty:
-                    st.session_state.chirps_data[f"{year}-{month}"] = df_chirps
-                
-                if current_date.month == 12:
-                    current_date = datetime(current_date.year + 1, 1, 1)
-                else:
-                    current_date = datetime(current_date.year, current_date.month + 1, 1)
+            # Every month shares the same tile window, so it is clipped to the bounding box once for all of them
+            process_date_range(tasks, plan, "❌ Failed to process data for {date_key}: {error}", clip_to=(lat_min, lat_max, lon_min, lon_max))
 
         if st.session_state.chirps_data:
             st.session_state.data_processed = True
@@ -180,30 +179,56 @@ if st.session_state.data_processed:
     if col_actions[0].button('Show Map 🗺️'):
         st.session_state.show_map = True
     
-    # Download ZIP Button
-    if col_actions[1].button('Download All Data (ZIP) ⬇️'):
-        with st.spinner('Creating ZIP archive...'):
-            zip_buffer = io.BytesIO()
-            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                for date_key, df_data in st.session_state.chirps_data.items():
-                    excel_buffer = io.BytesIO()
-                    df_data.to_excel(excel_buffer, index=False, engine='xlsxwriter')
-                    excel_buffer.seek(0)
-                    zip_file.writestr(f"CHIRPS_Data_{date_key}.xlsx", excel_buffer.getvalue())
-            
-            zip_buffer.seek(0)
-            
-            start_date_str = sorted(st.session_state.chirps_data.keys())[0]
-            end_date_str = sorted(st.session_state.chirps_data.keys())[-1]
-            zip_file_name = f"CHIRPS_Data_{start_date_str}_to_{end_date_str}.zip"
-            
-            st.download_button(
-                label="Click to Download ZIP File",
-                data=zip_buffer,
-                file_name=zip_file_name,
-                mime="application/zip"
-            )
-            st.success("✅ ZIP file ready for download!")
+    # Download Button
+    if col_actions[1].button('Download All Data ⬇️'):
+        start_date_str = sorted(st.session_state.chirps_data.keys())[0]
+        end_date_str = sorted(st.session_state.chirps_data.keys())[-1]
+
+        if bulk_format == "Parquet":
+            # All months go into one columnar file, distinguished by the Date_Range column
+            with st.spinner('Creating Parquet file...'):
+                combined_df = pd.concat([pd.read_parquet(st.session_state.chirps_data[date_key]) for date_key in sorted(st.session_state.chirps_data)], ignore_index=True)
+                parquet_buffer = io.BytesIO()
+                combined_df.to_parquet(parquet_buffer, engine='pyarrow', compression='zstd', index=False)
+                parquet_buffer.seek(0)
+
+                st.download_button(
+                    label="Click to Download Parquet File",
+                    data=parquet_buffer,
+                    file_name=f"CHIRPS_Data_{start_date_str}_to_{end_date_str}.parquet",
+                    mime="application/vnd.apache.parquet"
+                )
+                st.success("✅ Parquet file ready for download!")
+        else:
+            with st.spinner('Creating ZIP archive...'):
+                # Row counts come from the Parquet footers, so oversized months are found without loading them
+                skipped = [date_key for date_key, path in st.session_state.chirps_data.items() if pq.read_metadata(path).num_rows > EXCEL_MAX_ROWS]
+                if skipped:
+                    st.warning(f"Skipped {', '.join(skipped)}: more than {EXCEL_MAX_ROWS:,} rows do not fit in an Excel sheet. Use Parquet for these months.")
+
+                # Long ranges are written to Excel in parallel processes; the pool lives only for this export, so a crashed
+                # worker cannot break later downloads. .xlsx files are already compressed, so they are stored as-is
+                date_keys = [date_key for date_key in sorted(st.session_state.chirps_data) if date_key not in skipped]
+                jobs = [("Sheet1", st.session_state.chirps_data[date_key], str(Path(st.session_state.tmpdir.name) / f"{date_key}.xlsx")) for date_key in date_keys]
+                zip_buffer = io.BytesIO()
+                with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_STORED) as zip_file:
+                    # Entries are added in month order and streamed from disk, so no workbook is held in memory
+                    for date_key, ((_, _, excel_path), error) in zip(date_keys, write_excel_files(jobs)):
+                        if error is None:
+                            zip_file.write(excel_path, arcname=f"CHIRPS_Data_{date_key}.xlsx")
+                        else:
+                            st.error(f"❌ Failed to create the Excel file for {date_key}: {error}")
+                        Path(excel_path).unlink(missing_ok=True)
+                
+                zip_buffer.seek(0)
+                
+                st.download_button(
+                    label="Click to Download ZIP File",
+                    data=zip_buffer,
+                    file_name=f"CHIRPS_Data_{start_date_str}_to_{end_date_str}.zip",
+                    mime="application/zip"
+                )
+                st.success("✅ ZIP file ready for download!")
 
     # Show Map if 'Show Map' button is clicked
     if st.session_state.show_map:
@@ -212,15 +237,28 @@ if st.session_state.data_processed:
         dates = sorted(st.session_state.chirps_data.keys())
         
         if dates:
-            if len(dates) > 1:
-                selected_date_index = st.slider("Select Month Index for Map:", 0, len(dates) - 1, 0)
-                selected_date = dates[selected_date_index]
-                st.write(f"Displaying data for month: **{selected_date}**")
+            if len(dates) > 1 and st.checkbox("Show the mean of all months"):
+                # Months are averaged per pixel once, so the map costs the same however many months are loaded;
+                # like the months, the mean is kept as a Parquet file and only its path stays in session state
+                if st.session_state.monthly_mean is None:
+                    mean_path = Path(st.session_state.tmpdir.name) / "mean.parquet"
+                    mean_over_months(
+                        pd.read_parquet(path, columns=["Latitude", "Longitude", "Value"])
+                        for path in st.session_state.chirps_data.values()
+                    ).to_parquet(mean_path, compression='zstd', index=False)
+                    st.session_state.monthly_mean = str(mean_path)
+                selected_date = f"Mean {dates[0]} to {dates[-1]}"
+                st.write(f"Displaying the mean of all months: **{dates[0]}** to **{dates[-1]}**")
+                df_to_display = pd.read_parquet(st.session_state.monthly_mean)
             else:
-                selected_date = dates[0]
+                if len(dates) > 1:
+                    selected_date_index = st.slider("Select Month Index for Map:", 0, len(dates) - 1, 0)
+                    selected_date = dates[selected_date_index]
+                else:
+                    selected_date = dates[0]
                 st.write(f"Displaying data for month: **{selected_date}**")
-                
-            df_to_display = st.session_state.chirps_data[selected_date]
+                df_to_display = pd.read_parquet(st.session_state.chirps_data[selected_date])
+
             create_map(df_to_display, selected_date, point_size)
         else:
             st.warning("No data to visualize. Please process the data first.")
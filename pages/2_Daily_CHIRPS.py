@@ -1,13 +1,12 @@
 import streamlit as st
-import requests
-import rasterio
-import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
-import plotly.express as px
 import os
 import io
 import zipfile
+import tempfile
+import pyarrow.parquet as pq
+from chirps_core import snap_to_grid, get_chirps_data_daily, is_valid_bbox, process_date_range, EXCEL_MAX_ROWS, EXCEL_MAX_SHEETS, write_excel_sheets, show_daily_map
 
 # --- Streamlit Application Configuration ---
 st.set_page_config(
@@ -17,26 +16,32 @@ st.set_page_config(
 )
 
 # --- Initialize Session State ---
+# Processed days are stored as Parquet files in a per-session temp directory; session state only keeps their paths.
+# The directory is deleted when the session's state is released or the server stops
 if 'chirps_data' not in st.session_state:
     st.session_state.chirps_data = {}
+if 'tmpdir' not in st.session_state:
+    st.session_state.tmpdir = tempfile.TemporaryDirectory(prefix="chirps_")
 if 'data_processed' not in st.session_state:
     st.session_state.data_processed = False
 if 'show_map' not in st.session_state:
     st.session_state.show_map = False
+if 'processed_plan' not in st.session_state:
+    st.session_state.processed_plan = None
 
 # --- Application Title ---
 st.title("🌧️ CHIRPS Daily Data")
-st.markdown("This application allows you to download, process, and visualize CHIRPS v3.0 daily rainfall data. The data is downloaded in Excel format for easy processing.")
+st.markdown("This application allows you to download, process, and visualize CHIRPS v3.0 daily rainfall data. The data is downloaded in Parquet or Excel format for easy processing.")
 
 st.markdown("""
 This page is specifically for downloading daily rainfall data. Follow these steps:
 1.  **Select the Date Range**: In the sidebar, use the date pickers to select a **Start Date** and an **End Date**.
 2.  **Set Geographic Boundaries**: Enter the minimum and maximum latitude and longitude for your desired region.
-3.  **Adjust Point Size**: Use the slider to set the size of the points on the map.
+3.  **Adjust Point Size & Map Detail**: Use the sliders to set the size of the points on the map and how finely large areas are drawn.
 4.  **Process Data**: Click the **'Process Data'** button. The application will fetch and process data for each day in your selected range.
 5.  **Display & Download**:
     * Click **'Show Map'** to view the daily rainfall map. A slider will appear if you have selected more than one day.
-    * Click **'Download All Data (ZIP)'** to get a ZIP archive containing an Excel file for each day of data you requested.
+    * Click **'Download All Data'** to get every day you requested. **Parquet** (default) gives a single file with a `Date_Range` column; **Excel** gives a single workbook with one sheet per day; ranges longer than 366 days are split into several workbooks in a ZIP file.
 """)
 
 # --- User Input in Sidebar ---
@@ -49,6 +54,7 @@ with col_end:
     end_date = st.date_input("End Date:", value=datetime(2001, 1, 1), key='end_date')
 
 point_size = st.sidebar.slider("Set Point Size:", min_value=1, max_value=20, value=8, step=1)
+map_detail = st.sidebar.slider("Set Map Detail (cells per axis):", min_value=50, max_value=500, value=200, step=50)
 
 st.sidebar.markdown("---")
 st.sidebar.header("Set Geographic Boundaries")
@@ -61,96 +67,43 @@ with col2:
     lon_min = st.number_input("Longitude (Min):", value=104.0, step=0.1, format="%.1f")
     lon_max = st.number_input("Longitude (Max):", value=115.0, step=0.1, format="%.1f")
 
-# --- Function to Download and Process Data ---
-@st.cache_data(ttl=3600)
-def get_chirps_data_daily(date, lat_min, lat_max, lon_min, lon_max):
-    """Download daily CHIRPS data, process it, and return a DataFrame."""
-    year = date.year
-    month = f"{date.month:02d}"
-    day = f"{date.day:02d}"
-    
-    file_name = f"chirps-v3.0.{year}.{month}.{day}"
-    url = f"https://data.chc.ucsb.edu/products/CHIRPS/v3.0/daily/final/IMERGlate-v07/{year}/{file_name}.tif"
-
-    try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
-
-        tif_in_memory = io.BytesIO()
-        for chunk in response.iter_content(chunk_size=8192):
-            tif_in_memory.write(chunk)
-        tif_in_memory.seek(0)
-
-        with rasterio.open(tif_in_memory) as src:
-            band_data = src.read(1)
-            band_data = np.where(band_data == -9999.0, np.nan, band_data)
-            height, width = band_data.shape
-
-            lon_coords = np.linspace(src.bounds.left, src.bounds.right, width)
-            lat_coords = np.linspace(src.bounds.top, src.bounds.bottom, height)
-            lon, lat = np.meshgrid(lon_coords, lat_coords)
-
-            df = pd.DataFrame({
-                "Latitude": lat.flatten(),
-                "Longitude": lon.flatten(),
-                "Value": band_data.flatten()
-            })
-
-            df.dropna(inplace=True)
-            df_filtered = df[
-                (df["Latitude"] >= lat_min) & (df["Latitude"] <= lat_max) &
-                (df["Longitude"] >= lon_min) & (df["Longitude"] <= lon_max)
-            ].copy()
-
-            df_filtered['Date_Range'] = date.strftime('%Y-%m-%d')
-            
-            return df_filtered
-
-    except Exception as e:
-        st.error(f"❌ Failed to process data for {date.strftime('%Y-%m-%d')}: {e}")
-        return pd.DataFrame()
-
-# --- Function to Create Map ---
-def create_map(df, date_str, point_size):
-    st.info("This map displays consistent point size. You can adjust the size using the slider in the sidebar.")
-
-    fig = px.scatter_mapbox(df,
-                            lat="Latitude",
-                            lon="Longitude",
-                            color="Value",
-                            color_continuous_scale=px.colors.sequential.Viridis,
-                            zoom=5,
-                            mapbox_style="open-street-map",
-                            title=f"Rainfall (mm/day) - {date_str}",
-                            hover_data={"Latitude": ':.2f', "Longitude": ':.2f', "Value": ':.2f'})
-    
-    fig.update_layout(
-        margin={"r":0,"t":40,"l":0,"b":0},
-        coloraxis_colorbar=dict(title="Rainfall (mm)"),
-    )
-
-    fig.update_traces(marker=dict(size=point_size))
+st.sidebar.markdown("---")
+st.sidebar.header("Download Options")
+bulk_format = st.sidebar.radio("Bulk Download Format:", ["Parquet", "Excel"], help="Parquet is much faster to create and smaller to download. Excel is slower for long date ranges.")
 
-    st.plotly_chart(fig, use_container_width=True)
+# Cached reads are also kept on disk and never expire, so they can be removed here
+st.sidebar.markdown("---")
+if st.sidebar.button("Clear Cache 🗑️"):
+    get_chirps_data_daily.clear()
+    st.sidebar.success("Cached daily reads removed.")
+
+# --- Map Text ---
+MAP_TEXT = {
+    "info": "This map displays consistent point size. You can adjust the size using the slider in the sidebar. Large areas are averaged onto a coarser grid; raise Map Detail to show more points.",
+    "title": "Rainfall (mm/day)",
+    "value_label": "Rainfall (mm)",
+    "caption": "Color scale (Viridis): {min_v:.2f} mm (dark purple) to {max_v:.2f} mm (yellow)",
+}
 
 # --- Action Buttons ---
 st.markdown("---")
 if st.button('Process Data'):
+    bbox = [snap_to_grid(value) for value in (lat_min, lat_max, lon_min, lon_max)]
+    # The inputs that determine the data; clicking again with the same inputs keeps the processed days
+    plan = (start_date, end_date, *bbox)
+
     if start_date > end_date:
         st.error("The start date cannot be later than the end date.")
+    elif not is_valid_bbox(*bbox):
+        st.error("The minimum latitude and longitude must be smaller than the maximum values.")
+    elif plan == st.session_state.processed_plan:
+        st.info("This date range and area are already processed.")
     else:
-        st.session_state.chirps_data = {}
-        st.session_state.data_processed = False
-        st.session_state.show_map = False # Reset map status
-        current_date = start_date
-        
+        dates = [start_date + timedelta(days=i) for i in range((end_date - start_date).days + 1)]
+        tasks = {date.strftime('%Y-%m-%d'): (get_chirps_data_daily, "IMERGlate-v07", date, *bbox) for date in dates}
+
         with st.spinner(f'Downloading and processing data from {start_date} to {end_date}...'):
-            while current_date <= end_date:
-                df_chirps = get_chirps_data_daily(current_date, lat_min, lat_max, lon_min, lon_max)
-                if not df_chirps.empty:
-                    st.session_state.chirps_data[current_date.strftime('%Y-%m-%d')] = df_chirps
-                
-                current_date += timedelta(days=1)
+            process_date_range(tasks, plan, "❌ Failed to process data for {date_key}: {error}")
 
         if st.session_state.chirps_data:
             st.session_state.data_processed = True
@@ -168,30 +121,69 @@ if st.session_state.data_processed:
     if col_actions[0].button('Show Map 🗺️'):
         st.session_state.show_map = True
     
-    # Download ZIP Button
-    if col_actions[1].button('Download All Data (ZIP) ⬇️'):
-        with st.spinner('Creating ZIP archive...'):
-            zip_buffer = io.BytesIO()
-            with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-                for date_key, df_data in st.session_state.chirps_data.items():
-                    excel_buffer = io.BytesIO()
-                    df_data.to_excel(excel_buffer, index=False, engine='xlsxwriter')
-                    excel_buffer.seek(0)
-                    zip_file.writestr(f"CHIRPS_Data_{date_key}.xlsx", excel_buffer.getvalue())
-            
-            zip_buffer.seek(0)
-            
-            start_date_str = sorted(st.session_state.chirps_data.keys())[0]
-            end_date_str = sorted(st.session_state.chirps_data.keys())[-1]
-            zip_file_name = f"CHIRPS_Daily_Data_{start_date_str}_to_{end_date_str}.zip"
-            
-            st.download_button(
-                label="Click to Download ZIP File",
-                data=zip_buffer,
-                file_name=zip_file_name,
-                mime="application/zip"
-            )
-            st.success("✅ ZIP file ready for download!")
+    # Download Button
+    if col_actions[1].button('Download All Data ⬇️'):
+        start_date_str = sorted(st.session_state.chirps_data.keys())[0]
+        end_date_str = sorted(st.session_state.chirps_data.keys())[-1]
+
+        if bulk_format == "Parquet":
+            # All days go into one columnar file, distinguished by the Date_Range column
+            with st.spinner('Creating Parquet file...'):
+                combined_df = pd.concat([pd.read_parquet(path) for path in st.session_state.chirps_data.values()], ignore_index=True)
+                parquet_buffer = io.BytesIO()
+                combined_df.to_parquet(parquet_buffer, engine='pyarrow', compression='zstd', index=False)
+                parquet_buffer.seek(0)
+
+                st.download_button(
+                    label="Click to Download Parquet File",
+                    data=parquet_buffer,
+                    file_name=f"CHIRPS_Daily_Data_{start_date_str}_to_{end_date_str}.parquet",
+                    mime="application/vnd.apache.parquet"
+                )
+                st.success("✅ Parquet file ready for download!")
+        else:
+            # One workbook with a sheet per day: xlsxwriter is set up and zipped once per workbook, not once per day
+            with st.spinner('Creating Excel workbook...'):
+                # Row counts come from the Parquet footers, so oversized days are found without loading them
+                fits_excel = {date_key: pq.read_metadata(path).num_rows <= EXCEL_MAX_ROWS for date_key, path in st.session_state.chirps_data.items()}
+                skipped = [date_key for date_key, fits in fits_excel.items() if not fits]
+                if skipped:
+                    st.warning(f"Skipped {', '.join(skipped)}: more than {EXCEL_MAX_ROWS:,} rows do not fit in an Excel sheet. Use Parquet for these days.")
+
+                date_keys = sorted(date_key for date_key, fits in fits_excel.items() if fits)
+                batches = [date_keys[i:i + EXCEL_MAX_SHEETS] for i in range(0, len(date_keys), EXCEL_MAX_SHEETS)] or [[]]
+                try:
+                    if len(batches) == 1:
+                        excel_buffer = io.BytesIO()
+                        write_excel_sheets(excel_buffer, ((date_key, pd.read_parquet(st.session_state.chirps_data[date_key])) for date_key in batches[0]))
+                        excel_buffer.seek(0)
+
+                        st.download_button(
+                            label="Click to Download Excel File",
+                            data=excel_buffer,
+                            file_name=f"CHIRPS_Daily_Data_{start_date_str}_to_{end_date_str}.xlsx",
+                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+                        )
+                        st.success("✅ Excel file ready for download!")
+                    else:
+                        # Long ranges become several workbooks of at most EXCEL_MAX_SHEETS days, streamed into one ZIP;
+                        # .xlsx files are already compressed, so they are stored as-is
+                        zip_buffer = io.BytesIO()
+                        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_STORED) as zip_file:
+                            for batch in batches:
+                                with zip_file.open(f"CHIRPS_Daily_Data_{batch[0]}_to_{batch[-1]}.xlsx", 'w') as excel_entry:
+                                    write_excel_sheets(excel_entry, ((date_key, pd.read_parquet(st.session_state.chirps_data[date_key])) for date_key in batch))
+                        zip_buffer.seek(0)
+
+                        st.download_button(
+                            label="Click to Download ZIP File",
+                            data=zip_buffer,
+                            file_name=f"CHIRPS_Daily_Data_{start_date_str}_to_{end_date_str}.zip",
+                            mime="application/zip"
+                        )
+                        st.success(f"✅ ZIP file with {len(batches)} Excel workbooks of up to {EXCEL_MAX_SHEETS} days each ready for download!")
+                except Exception as e:
+                    st.error(f"❌ Failed to create the Excel file: {e}")
 
     # Show Map if 'Show Map' button is clicked
     if st.session_state.show_map:
@@ -208,8 +200,8 @@ if st.session_state.data_processed:
                 selected_date = dates[0]
                 st.write(f"Displaying data for date: **{selected_date}**")
                 
-            df_to_display = st.session_state.chirps_data[selected_date]
-            create_map(df_to_display, selected_date, point_size)
+            df_to_display = pd.read_parquet(st.session_state.chirps_data[selected_date])
+            show_daily_map(df_to_display, selected_date, point_size, map_detail, MAP_TEXT)
         else:
             st.warning("No data to visualize. Please process the data first.")
 